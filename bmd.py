@@ -184,6 +184,10 @@ def bmd_kbd_auth(challenge):
 
 class SpeedEditorHandler:
 
+	# Empty so subclasses can declare __slots__ of their own and get
+	# C-level attribute access on the hot event path
+	__slots__ = ()
+
 	def jog(self, mode: SpeedEditorJogMode, value):
 		pass
 
@@ -207,6 +211,7 @@ class SpeedEditor:
 
 	def __init__(self):
 		self.dev = hid.Device(self.USB_VID, self.USB_PID)
+		self._auth_timer = None
 
 	def authenticate(self):
 		# The authentication is performed over SET_FEATURE/GET_FEATURE on
@@ -244,10 +249,17 @@ class SpeedEditor:
 		# needs to be done again (returns 600 for me which is plausible)
 		timeout = int.from_bytes(data[2:4], 'little')
 		# reauthenticate 10 seconds before the timeout
-		scheduler = threading.Timer(timeout - 10, self.authenticate)
-		scheduler.start()
+		self._auth_timer = threading.Timer(timeout - 10, self.authenticate)
+		self._auth_timer.daemon = True
+		self._auth_timer.start()
 		return timeout
 
+	def close(self):
+		if self._auth_timer is not None:
+			self._auth_timer.cancel()
+			self._auth_timer = None
+		self.dev.close()
+
 	def set_handler(self, handler: SpeedEditorHandler):
 		self.handler = handler
 
@@ -285,10 +297,12 @@ class SpeedEditor:
 		rid, bs, bl = struct.unpack_from('<BBB', report)
 		return self.handler.battery(bool(bs), bl)
 
-	def poll(self, timeout=None):
-		# Get REPORT
-		report = self.dev.read(64, timeout=timeout)
-		if len(report) == 0:
+	def poll(self, timeout_ms=100):
+		# Get REPORT. We block in hid_read_timeout for up to timeout_ms:
+		# sleeping in the kernel until a report arrives is far cheaper than
+		# spinning in Python, and the timeout keeps callers' loops responsive
+		report = self.dev.read(64, timeout=timeout_ms)
+		if not report:
 			return
 
 		# Parse and dispatch to handler
@@ -2,6 +2,12 @@
 
 # Copyright (C) 2021 Sylvain Munaut <tnt@246tNt.com>
 # SPDX-License-Identifier: Apache-2.0
+import logging
+import logging.handlers
+import queue
+import signal
+import threading
+
 from datetime import datetime
 from typing import List
 
@@ -9,7 +15,25 @@ from bmd import SpeedEditorKey, SpeedEditorLed, SpeedEditorJogLed, SpeedEditorJo
 
 from pynput.keyboard import Key, Controller
 
+# Log through a queue so the hot event path only enqueues a record; the
+# actual formatting + stdout write() happens on the listener thread
+_log_queue = queue.SimpleQueue()
+logger = logging.getLogger('se')
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.setLevel(logging.INFO)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+
+# Key -> led lookup built once at import so the key-event path doesn't have
+# to go through getattr() reflection on every toggle; same for key names,
+# which would otherwise hit the IntEnum name property per logged key
+KEY_TO_LED = {k: SpeedEditorLed[k.name] for k in SpeedEditorKey if k.name in SpeedEditorLed.__members__}
+_KEY_NAMES = {k: k.name for k in SpeedEditorKey}
+
+
 class DemoHandler(SpeedEditorHandler):
+	__slots__ = ('se', 'keys', 'leds', 'keyboard')
+
 	JOG = {
 		SpeedEditorKey.SHTL: (SpeedEditorJogLed.SHTL, SpeedEditorJogMode.ABSOLUTE_DEADZERO),
 		SpeedEditorKey.JOG: (SpeedEditorJogLed.JOG, SpeedEditorJogMode.RELATIVE_2),
@@ -18,7 +42,7 @@ class DemoHandler(SpeedEditorHandler):
 
 	def __init__(self, se):
 		self.se = se
-		self.keys = []
+		self.keys = frozenset()
 		self.leds = 0
 		self.se.set_leds(self.leds)
 		self._set_jog_mode_for_key(SpeedEditorKey.SCRL)
@@ -26,13 +50,15 @@ class DemoHandler(SpeedEditorHandler):
 		self.keyboard = Controller()
 
 	def _set_jog_mode_for_key(self, key: SpeedEditorKey):
-		if key not in self.JOG:
+		entry = _JOG_ARR[key]
+		if entry is None:
 			return
-		self.se.set_jog_leds(self.JOG[key][0])
-		self.se.set_jog_mode(self.JOG[key][1])
+		self.se.set_jog_leds(entry[0])
+		self.se.set_jog_mode(entry[1])
 
 	def jog(self, mode: SpeedEditorJogMode, value):
-		print(f"Jog mode {mode:d} : {value:d}")
+		# %-args avoid the IntEnum __format__ round-trip of f-string ':d'
+		logger.info("Jog mode %d : %d", int(mode), value)
 
 		# example
 		# when the jog wheel is turned, we're simulating the press and release of left/right keys
@@ -45,42 +71,60 @@ class DemoHandler(SpeedEditorHandler):
 
 
 	def key(self, keys: List[SpeedEditorKey]):
-		# Debug message
-		kl = ', '.join([k.name for k in keys])
-		if not kl:
-			kl = 'None'
-		print(f"Keys held: {kl:s}")
+		# Debug message (skip the join entirely when logging is off)
+		if logger.isEnabledFor(logging.INFO):
+			kl = ', '.join(_KEY_NAMES[k] for k in keys) or 'None'
+			logger.info("Keys held: %s", kl)
 
 		# Find keys being released and toggle led if there is one
-		for k in self.keys:
-			if k not in keys:
-				# Select jog mode
-				self._set_jog_mode_for_key(k)
-
-				# Toggle leds
-				self.leds ^= getattr(SpeedEditorLed, k.name, 0)
-				self.se.set_leds(self.leds)
+		new_keys = frozenset(keys)
+		released = self.keys - new_keys
+		self.keys = new_keys
+		for k in released:
+			# Select jog mode
+			self._set_jog_mode_for_key(k)
 
-		self.keys = keys
+			# Toggle leds
+			self.leds ^= KEY_TO_LED.get(k, 0)
+			self.se.set_leds(self.leds)
 
 		# example
 		# pressing CAM1, will press the '1' key on the keyboard
-		if kl == 'CAM1':
+		if keys == [SpeedEditorKey.CAM1]:
 			self.keyboard.press('1')
 			self.keyboard.release('1')
 
 
 
 	def battery(self, charging: bool, level: int):
-		print(f"Battery {level:d} %{' and charging' if charging else '':s}")
+		logger.info("Battery %d %%%s", level, ' and charging' if charging else '')
+
+
+# Dense dispatch table indexed by int(SpeedEditorKey): a plain list index
+# skips the enum hashing a dict lookup does on every jog-mode switch
+_JOG_ARR = [None] * (max(SpeedEditorKey) + 1)
+for _k, _v in DemoHandler.JOG.items():
+	_JOG_ARR[_k] = _v
 
 
 if __name__ == '__main__':
-	print(datetime.now())
+	logger.info("%s", datetime.now())
 	se = SpeedEditor()
 	timeout = se.authenticate()
-	print(f"Timeout: {timeout:d}")
+	logger.info("Timeout: %d", timeout)
 	se.set_handler(DemoHandler(se))
 
-	while True:
-		se.poll()
+	# Block in the kernel (hid_read_timeout) instead of spinning: hidapi
+	# doesn't expose the hidraw fd so we can't select() on it, but a
+	# blocking read keeps idle CPU at ~0% all the same. Ctrl-C sets the
+	# stop flag and the device is closed on the way out.
+	stop = threading.Event()
+	signal.signal(signal.SIGINT, lambda *_: stop.set())
+	try:
+		poll = se.poll
+		while not stop.is_set():
+			poll(100)
+	finally:
+		se.close()
+		# flush anything still queued before the process exits
+		_log_listener.stop()
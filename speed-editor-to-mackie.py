@@ -6,16 +6,41 @@ Copyright (C) 2022 Ondrej Sindelar
 Copyright (C) 2021 Sylvain Munaut <tnt@246tNt.com>
 SPDX-License-Identifier: Apache-2.0
 """
+import atexit
+import logging
+import logging.handlers
+import queue
+import signal
 import threading
+import time
 from threading import Thread
 from typing import List
 
-import mido
+import rtmidi
 
 from bmd import SpeedEditorKey, SpeedEditorLed, SpeedEditorJogLed, SpeedEditorJogMode, SpeedEditorHandler, SpeedEditor
 
+# Log through a queue so the hot event path only enqueues a record; the
+# actual formatting + stdout write() happens on the listener thread
+_log_queue = queue.SimpleQueue()
+logger = logging.getLogger('se')
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.setLevel(logging.INFO)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+
+# Key -> led lookup built once at import so the key-event path doesn't have
+# to go through getattr() reflection on every toggle; same for key names,
+# which would otherwise hit the IntEnum name property per logged key
+KEY_TO_LED = {k: SpeedEditorLed[k.name] for k in SpeedEditorKey if k.name in SpeedEditorLed.__members__}
+_KEY_NAMES = {k: k.name for k in SpeedEditorKey}
+
 
 class MackieHandler(SpeedEditorHandler):
+    __slots__ = ('se', 'keys', 'leds', 'jog_mode', 'jog_unsent', '_speed_factor', 'midi_in', 'midi_out',
+                 '_mcu_state', '_state_lock', '_stop', '_jog_last_send',
+                 '_tx_q', '_tx_thread', '_send', '_note_msgs', '_jog_msg', '_zoom_next')
+
     # virtual midi loop ports (loopMIDI)
     midi_in_device = 'mackieIn'
     midi_out_device = 'mackieOut'
@@ -34,6 +59,12 @@ class MackieHandler(SpeedEditorHandler):
 
     ZOOM_REPEAT_TIME = 0.15
 
+    # Coalescing window for jog CC output - fast wheel spins produce many
+    # HID reports per ms, batching them into one flush keeps MIDI traffic
+    # sane. A burst bigger than JOG_FLUSH_MAX_STEPS steps flushes early.
+    JOG_FLUSH_TIME = 0.005
+    JOG_FLUSH_MAX_STEPS = 8
+
     MCU_JOG_CC = 0x3c
     MCU_STOP = 0x5D
     MCU_PLAY = 0x5E
@@ -45,25 +76,51 @@ class MackieHandler(SpeedEditorHandler):
     MCU_ZOOM = 0x64
     MCU_SCRUB = 0x65
 
-    ZOOM_KEYS = (SpeedEditorKey.IN, SpeedEditorKey.OUT, SpeedEditorKey.TRIM_IN, SpeedEditorKey.TRIM_OUT)
+    ZOOM_KEYS = frozenset({SpeedEditorKey.IN, SpeedEditorKey.OUT, SpeedEditorKey.TRIM_IN, SpeedEditorKey.TRIM_OUT})
+
+    # Bits of _mcu_state, written by the receive thread, read by the USB thread
+    STATE_PLAY = 1 << 0
+    STATE_ZOOM = 1 << 1
+    STATE_SCRUB = 1 << 2
 
     def __init__(self, se):
-        self.zoom_timer_on = False
         self.se = se
-        self.keys = set()
+        self.keys = frozenset()
         self.leds = 0
         self.se.set_leds(self.leds)
-        self.play_state = False
-        self.zoom_mode = False
-        self.scrub_mode = False
+        self._mcu_state = 0
+        self._state_lock = threading.Lock()
+        self._stop = threading.Event()
         self.jog_unsent = 0
+        self._jog_last_send = time.monotonic()
+        # USB thread produces into this queue, the tx thread consumes it and
+        # does the actual MIDI writes, so a slow backend can't stall polling
+        self._tx_q = queue.SimpleQueue()
         self._set_jog_mode_for_key(SpeedEditorKey.JOG)
-        device_name = self.find_device_in_list(self.midi_in_device, mido.get_output_names())
-        self.midi_out = mido.open_output(device_name)
-        device_name = self.find_device_in_list(self.midi_out_device, mido.get_input_names())
-        self.midi_in = mido.open_input(device_name)
-        thread = Thread(target=self.receive_thread)
-        thread.start()
+        # Output goes straight through python-rtmidi: send_message() takes
+        # raw bytes, skipping mido's per-message Message object and validation
+        self.midi_out = rtmidi.MidiOut()
+        out_ports = self.midi_out.get_ports()
+        self.midi_out.open_port(out_ports.index(self.find_device_in_list(self.midi_in_device, out_ports)))
+        # Input uses rtmidi's native callback: it fires on the backend's own
+        # thread with raw bytes, no Python receive loop or Message parsing
+        self.midi_in = rtmidi.MidiIn()
+        in_ports = self.midi_in.get_ports()
+        self.midi_in.open_port(in_ports.index(self.find_device_in_list(self.midi_out_device, in_ports)))
+        self.midi_in.set_callback(self._on_midi)
+        # Pre-build the raw bytes per note plus the jog CC and bind send once,
+        # so the hot path mutates and sends instead of allocating
+        self._send = self.midi_out.send_message
+        self._note_msgs = {n: (0x90, n, 127)
+                           for n in (self.MCU_STOP, self.MCU_PLAY, self.MCU_REC, self.MCU_ZOOM,
+                                     self.MCU_SCRUB, self.MCU_LEFT, self.MCU_RIGHT, self.MCU_UP, self.MCU_DOWN)}
+        self._jog_msg = [0xB0, self.MCU_JOG_CC, 0]
+        self._tx_thread = Thread(target=self._tx_loop, daemon=True)
+        self._tx_thread.start()
+        # Deadline for the next zoom repeat, checked by tick() from the main
+        # poll loop - no repeat thread racing the USB thread on self.keys
+        self._zoom_next = None
+        atexit.register(self.close)
 
     def find_device_in_list(self, device, list):
         full_device = next((n for n in list if n.startswith(device)), None)
@@ -71,24 +128,57 @@ class MackieHandler(SpeedEditorHandler):
             raise RuntimeError(f"Device {device} not found in list {list}")
         return full_device
 
-    def receive_thread(self):
+    @property
+    def play_state(self):
+        return bool(self._mcu_state & self.STATE_PLAY)
+
+    @property
+    def zoom_mode(self):
+        return bool(self._mcu_state & self.STATE_ZOOM)
+
+    @property
+    def scrub_mode(self):
+        return bool(self._mcu_state & self.STATE_SCRUB)
+
+    def _update_state(self, bit, on):
+        with self._state_lock:
+            if on:
+                self._mcu_state |= bit
+            else:
+                self._mcu_state &= ~bit
+
+    def _on_midi(self, event, data=None):
         "Receive MCU midi events -> register current states"
-        while True:
-            msg = self.midi_in.receive()
-            if msg.type == 'note_on':
-                if msg.note == self.MCU_PLAY:
-                    self.play_state = msg.velocity > 0
-                if msg.note == self.MCU_ZOOM:
-                    self.zoom_mode = msg.velocity > 0
-                if msg.note == self.MCU_SCRUB:
-                    self.scrub_mode = msg.velocity > 0
+        message, _delta = event
+        if len(message) == 3 and message[0] & 0xF0 == 0x90:
+            note = message[1]
+            vel = message[2]
+            if note == self.MCU_PLAY:
+                self._update_state(self.STATE_PLAY, vel > 0)
+            if note == self.MCU_ZOOM:
+                self._update_state(self.STATE_ZOOM, vel > 0)
+            if note == self.MCU_SCRUB:
+                self._update_state(self.STATE_SCRUB, vel > 0)
+
+    def close(self):
+        self._stop.set()
+        self._tx_q.put(None)
+        # let the writer drain everything queued before the sentinel so the
+        # last sends don't race the port close
+        self._tx_thread.join(timeout=1.0)
+        self.midi_in.close_port()
+        self.midi_out.close_port()
 
     def _set_jog_mode_for_key(self, key: SpeedEditorKey):
-        if key not in self.JOG:
+        entry = _JOG_ARR[key]
+        if entry is None:
             return
         self.jog_mode = key
-        self.se.set_jog_leds(self.JOG[key][0])
-        self.se.set_jog_mode(self.JOG[key][1])
+        # the factor only changes on mode switch, so cache it here rather
+        # than looking it up on every jog tick
+        self._speed_factor = _SPEED_ARR[key]
+        self.se.set_jog_leds(entry[0])
+        self.se.set_jog_mode(entry[1])
         if (key == SpeedEditorKey.SHTL) == (not self.scrub_mode):
             self.send_midi_note(self.MCU_SCRUB)
 
@@ -97,21 +187,32 @@ class MackieHandler(SpeedEditorHandler):
         value //= 360
         self.jog_unsent += value
 
-        speed_factor = self.JOG_SPEED_FACTOR[self.jog_mode]
-        value_to_send = self.jog_unsent // speed_factor
+        # Coalesce bursts on the wheel's own timeline: hold deltas until the
+        # flush window has elapsed or a large rotation has piled up. Slow
+        # single ticks pass straight through since the window is long past.
+        now = time.monotonic()
+        if now - self._jog_last_send < self.JOG_FLUSH_TIME \
+                and abs(self.jog_unsent) < self._speed_factor * self.JOG_FLUSH_MAX_STEPS:
+            return
+        self._emit_jog(now)
+
+    def _emit_jog(self, now):
+        "Send the whole MCU steps accumulated in jog_unsent, if any"
+        value_to_send = self.jog_unsent // self._speed_factor
         if value_to_send == 0:
             return
         # remaining sub-step wheel rotation - save for later
-        self.jog_unsent -= value_to_send * speed_factor
-        self.send_midi_jog_cc(value_to_send)
+        self.jog_unsent -= value_to_send * self._speed_factor
+        self._jog_last_send = now
+        self._tx_q.put(('jog', value_to_send))
 
     def key(self, keys: List[SpeedEditorKey]):
-        kl = ', '.join([k.name for k in keys])
-        if not kl:
-            kl = 'None'
-        print(f"Keys held: {kl:s}")
+        # skip the join entirely when logging is off
+        if logger.isEnabledFor(logging.INFO):
+            kl = ', '.join(_KEY_NAMES[k] for k in keys) or 'None'
+            logger.info("Keys held: %s", kl)
 
-        keys_set = set(keys)
+        keys_set = frozenset(keys)
         released = self.keys - keys_set
         pressed = keys_set - self.keys
         self.keys = keys_set
@@ -129,7 +230,7 @@ class MackieHandler(SpeedEditorHandler):
         self._set_jog_mode_for_key(k)
 
         # Toggle leds
-        self.leds ^= getattr(SpeedEditorLed, k.name, 0)
+        self.leds ^= KEY_TO_LED.get(k, 0)
         self.se.set_leds(self.leds)
 
         # stop/play -> send play or stop depending on current the state
@@ -141,55 +242,116 @@ class MackieHandler(SpeedEditorHandler):
         if k in self.ZOOM_KEYS:
             self.zoom_handle_keys()
 
+    def _tx_loop(self):
+        "MIDI writer thread: drains the tx queue and performs the actual sends"
+        q = self._tx_q
+        jog_pending = 0
+        while True:
+            if jog_pending:
+                # flush the coalesced jog delta once the queue runs dry
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    self._write_jog_cc(jog_pending)
+                    jog_pending = 0
+                    continue
+            else:
+                item = q.get()
+            if item is None:
+                if jog_pending:
+                    self._write_jog_cc(jog_pending)
+                break
+            kind, arg = item
+            if kind == 'jog':
+                jog_pending += arg
+            else:
+                if jog_pending:
+                    # keep ordering: flush jog before a note queued after it
+                    self._write_jog_cc(jog_pending)
+                    jog_pending = 0
+                self._send(self._note_msgs[arg])
+
     def send_midi_note(self, note):
-        self.midi_out.send(mido.Message('note_on', note=note, velocity=127))
-
-    def send_midi_jog_cc(self, shift: int):
-        abs_val_full = abs(shift)
-        while abs_val_full > 0:
-            abs_val = abs_val_full
-            if abs_val > 63:
-                abs_val = 63
-            sign = int(shift < 0) << 6
-            val = abs_val | sign
-            self.midi_out.send(mido.Message('control_change', control=self.MCU_JOG_CC, value=val))
-            abs_val_full -= abs_val
-
-    def set_zoom_mode(self):
-        if not self.zoom_mode:
-            self.send_midi_note(self.MCU_ZOOM)
-
-    def zoom_repeat(self):
-        self.zoom_timer_on = False
-        self.zoom_handle_keys()
-
-    def set_zoom_timer(self):
-        if not self.zoom_timer_on:
-            self.zoom_timer_on = True
-            zoom_timer = threading.Timer(self.ZOOM_REPEAT_TIME, self.zoom_repeat)
-            zoom_timer.start()
+        self._tx_q.put(('note', note))
+
+    def _write_jog_cc(self, shift: int):
+        send = self._send
+        msg = self._jog_msg
+        # MCU jog CC encodes magnitude in bits 0-5 and direction in bit 6;
+        # compute the sign bit once, outside the chunk loop
+        sign = 0x40 if shift < 0 else 0
+        remaining = -shift if shift < 0 else shift
+        while remaining:
+            chunk = remaining if remaining < 64 else 63
+            msg[2] = chunk | sign
+            send(msg)
+            remaining -= chunk
+
+    def tick(self):
+        "Called from the main loop after each poll: drives zoom repeat and jog flush"
+        now = time.monotonic()
+        # flush jog steps held back by the coalescing window once it has
+        # elapsed, so a burst that ends mid-window doesn't leave a stale
+        # residual to be prepended to the next gesture
+        if self.jog_unsent and now - self._jog_last_send >= self.JOG_FLUSH_TIME:
+            self._emit_jog(now)
+        if self._zoom_next is not None and now >= self._zoom_next:
+            self.zoom_handle_keys()
 
     def zoom_handle_keys(self):
-        zoom_pressed = False
-        if any(k in self.keys for k in self.ZOOM_KEYS):
-            self.set_zoom_mode()
-            zoom_pressed = True
-        if SpeedEditorKey.IN in self.keys:
-            self.send_midi_note(self.MCU_RIGHT)
-        if SpeedEditorKey.OUT in self.keys:
-            self.send_midi_note(self.MCU_LEFT)
-        if SpeedEditorKey.TRIM_IN in self.keys:
-            self.send_midi_note(self.MCU_DOWN)
-        if SpeedEditorKey.TRIM_OUT in self.keys:
-            self.send_midi_note(self.MCU_UP)
+        # Collect everything due this tick and hand it to the tx thread in
+        # one go rather than queueing through send_midi_note per note
+        keys = self.keys
+        notes = []
+        # single C-level set intersection instead of a Python any() generator
+        zoom_pressed = bool(keys & self.ZOOM_KEYS)
         if zoom_pressed:
-            self.set_zoom_timer()
+            if not self.zoom_mode:
+                notes.append(self.MCU_ZOOM)
+        if SpeedEditorKey.IN in keys:
+            notes.append(self.MCU_RIGHT)
+        if SpeedEditorKey.OUT in keys:
+            notes.append(self.MCU_LEFT)
+        if SpeedEditorKey.TRIM_IN in keys:
+            notes.append(self.MCU_DOWN)
+        if SpeedEditorKey.TRIM_OUT in keys:
+            notes.append(self.MCU_UP)
+        for n in notes:
+            self._tx_q.put(('note', n))
+        self._zoom_next = time.monotonic() + self.ZOOM_REPEAT_TIME if zoom_pressed else None
+
+
+# Dense dispatch tables indexed by int(SpeedEditorKey): a plain list index
+# skips the enum hashing a dict lookup does on every jog event
+_JOG_ARR = [None] * (max(SpeedEditorKey) + 1)
+for _k, _v in MackieHandler.JOG.items():
+    _JOG_ARR[_k] = _v
+_SPEED_ARR = [1] * (max(SpeedEditorKey) + 1)
+for _k, _v in MackieHandler.JOG_SPEED_FACTOR.items():
+    _SPEED_ARR[_k] = _v
 
 
 if __name__ == '__main__':
     se = SpeedEditor()
     se.authenticate()
-    se.set_handler(MackieHandler(se))
-
-    while True:
-        se.poll()
+    handler = MackieHandler(se)
+    se.set_handler(handler)
+
+    # Block in the kernel (hid_read_timeout) instead of spinning: hidapi
+    # doesn't expose the hidraw fd so we can't select() on it, but a
+    # blocking read keeps idle CPU at ~0% all the same. The 50 ms poll
+    # timeout bounds the zoom-repeat jitter from handler.tick(). Ctrl-C
+    # sets the stop flag and the MIDI ports + device are closed on exit.
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    try:
+        poll = se.poll
+        tick = handler.tick
+        while not stop.is_set():
+            poll(50)
+            tick()
+    finally:
+        handler.close()
+        se.close()
+        # flush anything still queued before the process exits
+        _log_listener.stop()